@@ -0,0 +1,425 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+'''
+Delta storage for exported device configurations.
+
+Every device gets its own directory holding a periodic full snapshot and
+line-based deltas for the versions in between:
+
+    <archive_dir>/<device>-<hash>/index.json
+    <archive_dir>/<device>-<hash>/<version>.full
+    <archive_dir>/<device>-<hash>/<version>.delta
+
+A snapshot and the deltas following it form a chain, old versions are
+expired one whole chain at a time.
+
+A delta is a sequence of operations against the previous version:
+
+    = START END     copy lines START:END of the previous version
+    + COUNT         insert the COUNT raw lines that follow
+'''
+
+from __future__ import print_function
+from __future__ import unicode_literals
+from dateutil.parser import parse
+import bisect
+import datetime
+import difflib
+import hashlib
+import json
+import logging
+import os
+import re
+
+
+logger = logging.getLogger(__name__)
+
+INDEX_FILE = 'index.json'
+# Size (old lines * new lines) of a range without unique lines above which
+# SequenceMatcher junks popular lines
+AUTOJUNK_THRESHOLD = 1000000
+
+
+class ArchiveException(Exception):
+    pass
+
+
+def _split_lines(data):
+    # bytes.splitlines() would also split on \r, \x0b etc. which would break
+    # the round trip of configs with mixed line endings
+    lines = data.split(b'\n')
+    last = lines.pop()
+    res = [x + b'\n' for x in lines]
+    if last:
+        res.append(last)
+    return res
+
+
+def _unique_anchors(old_lines, new_lines, o_lo, o_hi, n_lo, n_hi):
+    '''
+    Patience diff: lines occurring exactly once in both ranges, reduced to the
+    longest run that appears in the same order on both sides.
+    '''
+    counts = {}
+    for i in range(o_lo, o_hi):
+        c = counts.setdefault(old_lines[i], [0, 0, i])
+        c[0] += 1
+    for j in range(n_lo, n_hi):
+        c = counts.get(new_lines[j])
+        if c is not None:
+            c[1] += 1
+            c.append(j)
+    pairs = sorted((c[2], c[3]) for c in counts.values()
+                   if c[0] == 1 and c[1] == 1)
+    # Longest increasing subsequence of the new positions
+    tails = []
+    tails_idx = []
+    prev = [None] * len(pairs)
+    for k, (_, j) in enumerate(pairs):
+        pos = bisect.bisect_left(tails, j)
+        if pos == len(tails):
+            tails.append(j)
+            tails_idx.append(k)
+        else:
+            tails[pos] = j
+            tails_idx[pos] = k
+        prev[k] = tails_idx[pos - 1] if pos else None
+    res = []
+    k = tails_idx[-1] if tails_idx else None
+    while k is not None:
+        res.append(pairs[k])
+        k = prev[k]
+    return res[::-1]
+
+
+def _matching_blocks(old_lines, new_lines):
+    '''
+    Return the (i, j, size) blocks of lines shared by old_lines and new_lines
+    in ascending order.
+    '''
+    blocks = []
+    stack = [(0, len(old_lines), 0, len(new_lines))]
+    while stack:
+        o_lo, o_hi, n_lo, n_hi = stack.pop()
+        # Strip the common prefix and suffix, usually most of a config
+        start = 0
+        while (o_lo + start < o_hi and n_lo + start < n_hi and
+               old_lines[o_lo + start] == new_lines[n_lo + start]):
+            start += 1
+        if start:
+            blocks.append((o_lo, n_lo, start))
+            o_lo += start
+            n_lo += start
+        end = 0
+        while (o_hi - end > o_lo and n_hi - end > n_lo and
+               old_lines[o_hi - end - 1] == new_lines[n_hi - end - 1]):
+            end += 1
+        if end:
+            blocks.append((o_hi - end, n_hi - end, end))
+            o_hi -= end
+            n_hi -= end
+        if o_lo == o_hi or n_lo == n_hi:
+            continue
+        anchors = _unique_anchors(old_lines, new_lines, o_lo, o_hi, n_lo, n_hi)
+        if anchors:
+            # Recurse into the gaps around the anchors, each anchor becomes
+            # part of the common prefix of the gap following it
+            for i, j in anchors:
+                stack.append((o_lo, i, n_lo, j))
+                o_lo, n_lo = i, j
+            stack.append((o_lo, o_hi, n_lo, n_hi))
+        else:
+            # Nothing but repeated lines (!, exit, ...) left. SequenceMatcher
+            # is quadratic on those, on large ranges autojunk bounds it at
+            # the cost of a larger delta
+            matcher = difflib.SequenceMatcher(
+                None, old_lines[o_lo:o_hi], new_lines[n_lo:n_hi],
+                autojunk=(o_hi - o_lo) * (n_hi - n_lo) > AUTOJUNK_THRESHOLD
+            )
+            for i, j, size in matcher.get_matching_blocks():
+                if size:
+                    blocks.append((o_lo + i, n_lo + j, size))
+    # Merge adjacent blocks so that each run of unchanged lines is one op
+    merged = []
+    for i, j, size in sorted(blocks):
+        if merged and merged[-1][0] + merged[-1][2] == i and \
+                merged[-1][1] + merged[-1][2] == j:
+            merged[-1][2] += size
+        else:
+            merged.append([i, j, size])
+    return merged
+
+
+def make_delta(old_lines, new_lines):
+    delta = []
+    j_pos = 0
+    for i, j, size in _matching_blocks(old_lines, new_lines):
+        if j > j_pos:
+            delta.append('+ {}\n'.format(j - j_pos).encode('ascii'))
+            delta.extend(new_lines[j_pos:j])
+        delta.append('= {} {}\n'.format(i, i + size).encode('ascii'))
+        j_pos = j + size
+    if j_pos < len(new_lines):
+        delta.append('+ {}\n'.format(len(new_lines) - j_pos).encode('ascii'))
+        delta.extend(new_lines[j_pos:])
+    return b''.join(delta)
+
+
+def apply_delta(old_lines, delta):
+    lines = _split_lines(delta)
+    res = []
+    pos = 0
+    while pos < len(lines):
+        op = lines[pos].decode('ascii').split()
+        pos += 1
+        if op[0] == '=':
+            res.extend(old_lines[int(op[1]):int(op[2])])
+        elif op[0] == '+':
+            count = int(op[1])
+            res.extend(lines[pos:pos + count])
+            pos += count
+        else:
+            raise ArchiveException('Invalid delta operation: {}'.format(op))
+    return res
+
+
+def _mark_missing_newlines(diff):
+    # Same marker as diff(1), otherwise the last line of a file without
+    # trailing newline runs into the next output line
+    for line in diff:
+        if line.endswith('\n'):
+            yield line
+        else:
+            yield line + '\n'
+            yield '\\ No newline at end of file\n'
+
+
+def _safe_name(name):
+    # The hash keeps names like "sw 1" and "sw_1" from sharing a directory
+    name = str(name)
+    digest = hashlib.sha1(name.encode('utf-8')).hexdigest()[:8]
+    return '{}-{}'.format(re.sub(r'[^\w.-]', '_', name), digest)
+
+
+def _parse_date(date, end_of_day=False):
+    '''
+    Parse date into a naive UTC datetime so that naive and aware dates can be
+    compared. Naive dates are assumed to be UTC already. With end_of_day set,
+    a date without a time of day means the end of that day.
+    '''
+    if not isinstance(date, datetime.datetime):
+        res = parse(date)
+        if end_of_day:
+            # Parsing with a different default only changes the hour if the
+            # time of day was left out
+            end = parse(date, default=datetime.datetime(
+                res.year, res.month, res.day, 23, 59, 59, 999999
+            ))
+            if end.hour != res.hour:
+                res = end
+        date = res
+    if date.tzinfo is not None:
+        date = date.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return date
+
+
+class DeltaArchive(object):
+    def __init__(self, archive_dir, snapshot_interval=10):
+        self.archive_dir = archive_dir
+        self.snapshot_interval = snapshot_interval
+
+    def _device_dir(self, device):
+        return os.path.join(self.archive_dir, _safe_name(device))
+
+    def _read_index(self, device):
+        index_path = os.path.join(self._device_dir(device), INDEX_FILE)
+        if not os.path.exists(index_path):
+            return []
+        with open(index_path) as f:
+            return json.load(f)
+
+    def _write_index(self, device, index):
+        index_path = os.path.join(self._device_dir(device), INDEX_FILE)
+        tmp_path = '{}.tmp'.format(index_path)
+        with open(tmp_path, 'w') as f:
+            json.dump(index, f, indent=2)
+        os.replace(tmp_path, index_path)
+
+    def _read_file(self, device, filename):
+        with open(os.path.join(self._device_dir(device), filename), 'rb') as f:
+            return f.read()
+
+    def _write_file(self, device, filename, data):
+        with open(os.path.join(self._device_dir(device), filename), 'wb') as f:
+            f.write(data)
+
+    def list_versions(self, device):
+        return self._read_index(device)
+
+    def add(self, device, data, date, filename=None, backup_id=None):
+        '''
+        Store a new version of the configuration of device. date is an ISO
+        8601 string and must not be older than the latest archived version.
+        Returns the version, which is the latest one if it is identical.
+        '''
+        os.makedirs(self._device_dir(device), exist_ok=True)
+        index = self._read_index(device)
+        latest_lines = None
+        if index:
+            latest = index[-1]
+            if backup_id is not None and latest['BackupID'] == backup_id:
+                logger.info(
+                    'Backup {} of {} is already archived as version {}'.format(
+                        backup_id, device, latest['Version']
+                    )
+                )
+                return latest['Version']
+            if _parse_date(date) < _parse_date(latest['Date']):
+                raise ArchiveException(
+                    'Cannot archive {} of {}: older than version {} ({})'.format(
+                        date, device, latest['Version'], latest['Date']
+                    )
+                )
+            latest_lines = self._lines(device, index, len(index) - 1)
+            if b''.join(latest_lines) == data:
+                logger.info(
+                    'Configuration of {} unchanged since version {}'.format(
+                        device, latest['Version']
+                    )
+                )
+                return latest['Version']
+        version = index[-1]['Version'] + 1 if index else 0
+        # Start a new chain every snapshot_interval versions so that
+        # reconstructing a version never has to replay more deltas than that
+        if not index or version % self.snapshot_interval == 0:
+            storage = 'full'
+            payload = data
+        else:
+            storage = 'delta'
+            payload = make_delta(latest_lines, _split_lines(data))
+        storage_file = '{}.{}'.format(version, storage)
+        self._write_file(device, storage_file, payload)
+        index.append({
+            'Version': version,
+            'Device': str(device),
+            'Date': date,
+            'BackupID': backup_id,
+            'Filename': filename,
+            'File': storage_file,
+            'Size': len(data)
+        })
+        self._write_index(device, index)
+        logger.info(
+            'Archived version {} of {} ({}, {}/{} bytes)'.format(
+                version, device, storage, len(payload), len(data)
+            )
+        )
+        return version
+
+    def list_devices(self):
+        devices = []
+        if not os.path.isdir(self.archive_dir):
+            return devices
+        for d in sorted(os.listdir(self.archive_dir)):
+            index_path = os.path.join(self.archive_dir, d, INDEX_FILE)
+            if not os.path.exists(index_path):
+                continue
+            with open(index_path) as f:
+                index = json.load(f)
+            if index:
+                devices.append(index[0]['Device'])
+        return devices
+
+    def prune(self, device, before):
+        '''
+        Delete the chains of device whose versions are all older than before.
+        The latest chain is always kept. Returns the deleted versions.
+        '''
+        before = _parse_date(before)
+        index = self._read_index(device)
+        starts = [pos for pos, entry in enumerate(index)
+                  if entry['File'].endswith('.full')]
+        keep_from = 0
+        for start, end in zip(starts, starts[1:]):
+            if _parse_date(index[end - 1]['Date']) >= before:
+                break
+            keep_from = end
+        if not keep_from:
+            return []
+        pruned = index[:keep_from]
+        # Rewrite the index first so that it never references deleted files
+        self._write_index(device, index[keep_from:])
+        for entry in pruned:
+            os.unlink(os.path.join(self._device_dir(device), entry['File']))
+        logger.info(
+            'Pruned {} versions of {} older than {}'.format(
+                len(pruned), device, before
+            )
+        )
+        return [x['Version'] for x in pruned]
+
+    def prune_all(self, before):
+        return {dev: self.prune(dev, before) for dev in self.list_devices()}
+
+    def _lines(self, device, index, pos):
+        start = pos
+        while not index[start]['File'].endswith('.full'):
+            start -= 1
+        lines = _split_lines(self._read_file(device, index[start]['File']))
+        for entry in index[start + 1:pos + 1]:
+            lines = apply_delta(lines, self._read_file(device, entry['File']))
+        return lines
+
+    def _position(self, device, index, version):
+        for pos, entry in enumerate(index):
+            if entry['Version'] == version:
+                return pos
+        raise ArchiveException(
+            'No version {} archived for {}'.format(version, device)
+        )
+
+    def get(self, device, version=None):
+        '''
+        Reconstruct a version of the configuration of device (Default: latest)
+        '''
+        index = self._read_index(device)
+        if not index:
+            raise ArchiveException('No versions archived for {}'.format(device))
+        pos = len(index) - 1 if version is None else \
+            self._position(device, index, version)
+        return b''.join(self._lines(device, index, pos))
+
+    def find_version(self, device, date):
+        '''
+        Return the latest version of device archived at or before date. A
+        date without a time of day includes the whole day.
+        '''
+        date = _parse_date(date, end_of_day=True)
+        res = None
+        for entry in self._read_index(device):
+            entry_date = _parse_date(entry['Date'])
+            if entry_date <= date and (res is None or entry_date >= res[0]):
+                res = (entry_date, entry['Version'])
+        return res[1] if res else None
+
+    def diff(self, device, from_version=None, to_version=None):
+        '''
+        Unified diff between two versions of device. Defaults to the diff
+        between the two most recent versions.
+        '''
+        index = self._read_index(device)
+        if not index:
+            raise ArchiveException('No versions archived for {}'.format(device))
+        to_pos = len(index) - 1 if to_version is None else \
+            self._position(device, index, to_version)
+        from_pos = max(to_pos - 1, 0) if from_version is None else \
+            self._position(device, index, from_version)
+        old = self._lines(device, index, from_pos)
+        new = self._lines(device, index, to_pos)
+        return _mark_missing_newlines(difflib.unified_diff(
+            [x.decode('utf-8', 'replace') for x in old],
+            [x.decode('utf-8', 'replace') for x in new],
+            fromfile='{} ({})'.format(device, index[from_pos]['Date']),
+            tofile='{} ({})'.format(device, index[to_pos]['Date'])
+        ))
@@ -7,15 +7,20 @@ https://restorepoint.freshdesk.com/support/solutions/articles/9000098438-api-doc
 
 from __future__ import print_function
 from __future__ import unicode_literals
+from .archive import ArchiveException, DeltaArchive
 from dateutil.parser import parse
 import pathos.multiprocessing as mp
+import pathos.threading as mt
 import cgi
+import collections
 import copy
 import functools
 import json
 import logging
 import os
 import requests
+import shutil
+import tempfile
 import time
 import urllib.parse
 
@@ -41,6 +46,25 @@ class GenericException(Exception):
     pass
 
 
+# Fields of the entries returned by deviceerrors
+DEVICE_ERROR_CATEGORY = 'Type'
+DEVICE_ERROR_MESSAGE = 'Message'
+
+
+def _error_category(error):
+    if isinstance(error, dict) and error.get(DEVICE_ERROR_CATEGORY):
+        return str(error[DEVICE_ERROR_CATEGORY])
+    return 'Uncategorized'
+
+
+def _error_message(error):
+    if isinstance(error, dict):
+        if error.get(DEVICE_ERROR_MESSAGE):
+            return str(error[DEVICE_ERROR_MESSAGE])
+        return json.dumps(error, sort_keys=True)
+    return str(error)
+
+
 class RestorePoint(object):
     def __init__(self, hostname, username, password, port=443, verify=True):
         self.hostname = hostname
@@ -272,6 +296,62 @@ class RestorePoint(object):
     def list_failed_backups(self):
         return [x for x in self.list_devices_status() if not x['BackupStatus']]
 
+    def fleet_health(self, max_workers=16):
+        statuses = self.list_devices_status()
+        failed = [x for x in statuses if not x['BackupStatus']]
+
+        def fetch_errors(dev):
+            try:
+                errors = self.device_errors(dev['ID'])
+            except (requests.exceptions.RequestException,
+                    GenericException) as exc:
+                # Permission and login errors are not specific to a device
+                # and propagate
+                logger.error(
+                    'Could not fetch errors of device {}: {}'.format(
+                        dev['ID'], exc
+                    )
+                )
+                errors = [{
+                    DEVICE_ERROR_CATEGORY: 'Request failed',
+                    DEVICE_ERROR_MESSAGE: str(exc)
+                }]
+            # Like listdevices, the errors may be wrapped in {'Rows': [...]}
+            if isinstance(errors, dict) and 'Rows' in errors:
+                errors = errors.get('Rows') or []
+            if not isinstance(errors, list):
+                errors = [errors] if errors else []
+            return errors
+
+        # device_errors is one round trip per device, fetch them concurrently
+        # but without flooding the appliance
+        pool = mt.ThreadPool(nodes=max(1, min(max_workers, len(failed))))
+        all_errors = pool.map(fetch_errors, failed) if failed else []
+
+        devices = []
+        categories = collections.OrderedDict()
+        for dev, errors in zip(failed, all_errors):
+            name = dev.get('Name', dev['ID'])
+            devices.append({
+                'ID': dev['ID'],
+                'Name': name,
+                'Errors': [_error_message(x) for x in errors]
+            })
+            for error in errors or [None]:
+                category = _error_category(error)
+                cat = categories.setdefault(
+                    category, {'Count': 0, 'Devices': []}
+                )
+                cat['Count'] += 1
+                if name not in cat['Devices']:
+                    cat['Devices'].append(name)
+        return {
+            'Total': len(statuses),
+            'Failed': len(failed),
+            'Categories': categories,
+            'Devices': devices
+        }
+
     def export_backup(self, backup_id, dest_dir=None, chunk_size=2000):
         data = {
             'msg': 'exportbackup',
@@ -309,10 +389,53 @@ class RestorePoint(object):
                 f.write(chunk)
         return backup_id, filepath
 
-    def export_latest_backups(self, device_ids, dest_dir=None):
-        latest_backups = [b['ID'] for b in self.latest_backups(device_ids)]
+    def archive_backup(self, backup_id, archive_dir, device_name, date=None,
+                       snapshot_interval=10):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            _, filepath = self.export_backup(backup_id, dest_dir=tmp_dir)
+            with open(filepath, 'rb') as f:
+                data = f.read()
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        archive = DeltaArchive(archive_dir, snapshot_interval)
+        try:
+            archive.add(
+                device_name,
+                data,
+                date=date if date else time.strftime('%Y-%m-%dT%H:%M:%S'),
+                filename=os.path.basename(filepath),
+                backup_id=backup_id
+            )
+        except ArchiveException as exc:
+            # Runs in a worker process, raising would abort the export of
+            # every other device
+            logger.error('Could not archive backup {} of {}: {}'.format(
+                backup_id, device_name, exc
+            ))
+            return backup_id, None
+        return backup_id, archive_dir
+
+    def export_latest_backups(self, device_ids, dest_dir=None,
+                              archive_dir=None):
+        latest = self.latest_backups(device_ids)
+        latest_backups = [b['ID'] for b in latest]
         pool = mp.ProcessingPool()
-        func = functools.partial(self.export_backup, dest_dir=dest_dir)
+        if archive_dir:
+            # Store the exports as deltas against the previous export of the
+            # same device instead of full files
+            device_names = {x['ID']: x['Name'] for x in self.list_devices()}
+
+            def func(backup_id):
+                b = [x for x in latest if x['ID'] == backup_id][0]
+                return self.archive_backup(
+                    backup_id,
+                    archive_dir,
+                    device_names.get(b['DeviceID'], b['DeviceID']),
+                    date=b.get('Dt')
+                )
+        else:
+            func = functools.partial(self.export_backup, dest_dir=dest_dir)
         res = pool.amap(func, latest_backups)
         while not res.ready():
             logger.info(
@@ -341,9 +464,9 @@ class RestorePoint(object):
         #     )
         # return exports
 
-    def export_all_latest_backups(self, dest_dir=None):
+    def export_all_latest_backups(self, dest_dir=None, archive_dir=None):
         device_ids = self.get_all_device_ids()
-        return self.export_latest_backups(device_ids, dest_dir)
+        return self.export_latest_backups(device_ids, dest_dir, archive_dir)
 
     def abort_backup_job(self, job_id):
         return self.__rq(msg='abortjob', params={'jobid': job_id})
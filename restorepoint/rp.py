@@ -4,7 +4,10 @@
 from __future__ import print_function
 from __future__ import unicode_literals
 from restorepoint import RestorePoint
+from restorepoint.archive import ArchiveException, DeltaArchive
 import argparse
+import datetime
+import json
 import logging
 import os
 import shutil
@@ -20,20 +23,17 @@ def parse_args():
     parser.add_argument(
         '-u',
         '--username',
-        required=True,
         help='Username to connect to RestorePoint'
     )
     parser.add_argument(
         '-p',
         '--password',
-        required=True,
         help='Password to connect to RestorePoint'
     )
     parser.add_argument(
         '-H',
         '--hostname',
-        help='RestorePoint Hostname',
-        required=True
+        help='RestorePoint Hostname'
     )
     parser.add_argument(
         '-k',
@@ -90,6 +90,19 @@ def parse_args():
         default=None,
         required=False
     )
+    export_parser.add_argument(
+        '-a',
+        '--archive',
+        help='Store exports as deltas in this archive directory',
+        default=None,
+        required=False
+    )
+    export_parser.add_argument(
+        '--keep-days',
+        type=int,
+        help='Expire archived exports older than this many days',
+        default=None
+    )
     export_parser.add_argument(
         '-i',
         '--ignore-disabled',
@@ -128,6 +141,52 @@ def parse_args():
         nargs='*',
         help='Optinal device name to export (Default: all)'
     )
+    diff_parser = subparsers.add_parser(
+        'diff',
+        help='Diff two archived exports of a device'
+    )
+    diff_parser.add_argument(
+        '-a',
+        '--archive',
+        help='Archive directory',
+        required=True
+    )
+    diff_parser.add_argument(
+        '--from',
+        dest='from_date',
+        help='Diff from the latest export at or before this date '
+             '(Default: previous export)',
+        default=None
+    )
+    diff_parser.add_argument(
+        '--to',
+        dest='to_date',
+        help='Diff to the latest export at or before this date '
+             '(Default: latest export)',
+        default=None
+    )
+    diff_parser.add_argument(
+        'DEVICE',
+        help='Device name'
+    )
+    health_parser = subparsers.add_parser(
+        'health',
+        help='Report why backups failed across the fleet'
+    )
+    health_parser.add_argument(
+        '-j',
+        '--json',
+        help='Print the report as JSON',
+        action='store_true',
+        default=False
+    )
+    health_parser.add_argument(
+        '-w',
+        '--workers',
+        type=int,
+        help='Maximum number of concurrent requests (Default: 16)',
+        default=16
+    )
     prune_parser = subparsers.add_parser(
         'prune',
         help='Prune the latest backup of one or more devices'
@@ -149,7 +208,25 @@ def parse_args():
         nargs='*',
         help='Optinal device name to prune (Default: all)'
     )
-    return parser.parse_args()
+    args = parser.parse_args()
+    # Diffing only reads the local archive, every other action logs in
+    if args.action != 'diff':
+        missing = [x for x in ['username', 'password', 'hostname']
+                   if getattr(args, x) is None]
+        if missing:
+            parser.error(
+                'the following arguments are required: {}'.format(
+                    ', '.join('--{}'.format(x) for x in missing)
+                )
+            )
+    if args.action == 'export':
+        if args.archive and (args.destination or args.clean):
+            parser.error(
+                '--archive cannot be combined with --destination or --clean'
+            )
+        if args.keep_days is not None and not args.archive:
+            parser.error('--keep-days requires --archive')
+    return args
 
 
 def empty_dir(directory):
@@ -221,8 +298,66 @@ def display_export_results(rp, res, errors_only=False):
             )
 
 
+def display_health_report(report):
+    print('{}/{} devices failed to backup'.format(
+        report['Failed'], report['Total']
+    ))
+    if not report['Failed']:
+        return
+    print()
+    width = max(len(str(x)) for x in report['Categories'])
+    for category, info in sorted(report['Categories'].items(),
+                                 key=lambda x: x[1]['Count'],
+                                 reverse=True):
+        print('{:<{}}  {:>5}  {}'.format(
+            category, width, info['Count'], ', '.join(str(x) for x in info['Devices'])
+        ))
+    print()
+    for dev in sorted(report['Devices'], key=lambda x: str(x['Name']).lower()):
+        print('{}:'.format(dev['Name']))
+        for error in dev['Errors'] or ['No error reported']:
+            print('    {}'.format(error))
+
+
+def diff_archive(args):
+    archive = DeltaArchive(args.archive)
+    versions = {}
+    for key in ['from_date', 'to_date']:
+        date = getattr(args, key)
+        if date is None:
+            versions[key] = None
+            continue
+        try:
+            versions[key] = archive.find_version(args.DEVICE, date)
+        except ValueError as exc:
+            print('Invalid date {}: {}'.format(date, exc), file=sys.stderr)
+            sys.exit(4)
+        if versions[key] is None:
+            print(
+                'No export of {} archived at or before {}'.format(
+                    args.DEVICE, date
+                ),
+                file=sys.stderr
+            )
+            sys.exit(4)
+    try:
+        diff = archive.diff(
+            args.DEVICE,
+            from_version=versions['from_date'],
+            to_version=versions['to_date']
+        )
+        for line in diff:
+            sys.stdout.write(line)
+    except ArchiveException as exc:
+        print(exc, file=sys.stderr)
+        sys.exit(4)
+
+
 def main():
     args = parse_args()
+    if args.action == 'diff':
+        diff_archive(args)
+        sys.exit(0)
     rp = RestorePoint(
         hostname=args.hostname,
         username=args.username,
@@ -267,7 +402,13 @@ def main():
             backup_res = rp.backup_devices_block(device_ids,
                                                  sleep_interval=args.sleep)
         # Export the devices whose IDs could be determined
-        res = rp.export_latest_backups(device_ids, args.destination)
+        res = rp.export_latest_backups(device_ids, args.destination,
+                                       args.archive)
+        if args.keep_days is not None:
+            DeltaArchive(args.archive).prune_all(
+                datetime.datetime.now() -
+                datetime.timedelta(days=args.keep_days)
+            )
         # Print results
         if args.force_backup:
             display_backup_results(rp, backup_res, args.errors_only)
@@ -280,6 +421,13 @@ def main():
                 except Exception as exc:
                     print('Something went wrong while pruning backups of'
                           ' {}: {}'.format(dev_id, exc))
+    elif args.action == 'health':
+        report = rp.fleet_health(max_workers=args.workers)
+        if args.json:
+            print(json.dumps(report, indent=2))
+        else:
+            display_health_report(report)
+        exit_code = 1 if report['Failed'] else 0
     elif args.action == 'prune':
         device_ids = get_device_ids(rp, args.DEVICE, args.exclude)
         for dev_id in device_ids:
@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+from __future__ import unicode_literals
+from restorepoint.archive import (ArchiveException, DeltaArchive,
+                                  _split_lines, apply_delta, make_delta)
+import os
+import random
+import pytest
+
+
+def random_config(rnd, length):
+    lines = [rnd.choice([b'!\n', b' exit\n', b'\r\n', b'\n'])
+             if rnd.random() < 0.4 else
+             'hostname sw{}\n'.format(rnd.randrange(1000)).encode('ascii')
+             for _ in range(length)]
+    if lines and rnd.random() < 0.5:
+        # No trailing newline
+        lines[-1] = lines[-1].rstrip(b'\n') or b'end'
+    return b''.join(lines)
+
+
+def mutate(rnd, data):
+    lines = _split_lines(data)
+    for _ in range(rnd.randrange(1, 6)):
+        op = rnd.choice(['insert', 'delete', 'replace'])
+        pos = rnd.randrange(len(lines) + 1)
+        if op == 'insert':
+            lines.insert(pos, b'interface Gi0/%d\n' % rnd.randrange(48))
+        elif lines and pos < len(lines):
+            if op == 'delete':
+                del lines[pos]
+            else:
+                lines[pos] = b' description changed\n'
+    data = b''.join(lines)
+    if rnd.random() < 0.3:
+        data = data.rstrip(b'\n')
+    return data
+
+
+@pytest.fixture
+def archive(tmp_path):
+    return DeltaArchive(str(tmp_path), snapshot_interval=4)
+
+
+def test_delta_roundtrip():
+    rnd = random.Random(0)
+    for _ in range(200):
+        old = random_config(rnd, rnd.randrange(60))
+        new = mutate(rnd, old)
+        old_lines = _split_lines(old)
+        delta = make_delta(old_lines, _split_lines(new))
+        assert b''.join(apply_delta(old_lines, delta)) == new
+
+
+def test_delta_binary_roundtrip():
+    rnd = random.Random(1)
+    old = bytes(rnd.randrange(256) for _ in range(4096))
+    new = old[:1000] + b'\n\r\x00' + old[1200:]
+    old_lines = _split_lines(old)
+    delta = make_delta(old_lines, _split_lines(new))
+    assert b''.join(apply_delta(old_lines, delta)) == new
+
+
+def test_archive_roundtrip(archive):
+    rnd = random.Random(2)
+    data = random_config(rnd, 200)
+    versions = []
+    for day in range(1, 26):
+        data = mutate(rnd, data)
+        versions.append(data)
+        archive.add('sw 1', data, '2026-01-{:02d}T10:00:00'.format(day),
+                    backup_id=day)
+    files = [x['File'] for x in archive.list_versions('sw 1')]
+    assert [x for x in files if x.endswith('.full')] == \
+        ['0.full', '4.full', '8.full', '12.full', '16.full', '20.full',
+         '24.full']
+    for version, data in enumerate(versions):
+        assert archive.get('sw 1', version) == data
+    assert archive.get('sw 1') == versions[-1]
+
+
+def test_add_skips_duplicates(archive):
+    assert archive.add('sw1', b'a\n', '2026-01-01', backup_id=1) == 0
+    assert archive.add('sw1', b'b\n', '2026-01-02', backup_id=1) == 0
+    assert archive.add('sw1', b'a\n', '2026-01-02', backup_id=2) == 0
+    assert len(archive.list_versions('sw1')) == 1
+
+
+def test_add_rejects_older_versions(archive):
+    archive.add('sw1', b'a\n', '2026-01-02T00:00:00')
+    with pytest.raises(ArchiveException):
+        archive.add('sw1', b'b\n', '2026-01-01T00:00:00')
+
+
+def test_device_name_collisions(archive, tmp_path):
+    archive.add('sw 1', b'a\n', '2026-01-01')
+    archive.add('sw_1', b'b\n', '2026-01-01')
+    assert len(os.listdir(str(tmp_path))) == 2
+    assert sorted(archive.list_devices()) == ['sw 1', 'sw_1']
+    assert archive.get('sw 1') == b'a\n'
+    assert archive.get('sw_1') == b'b\n'
+
+
+def test_find_version(archive):
+    for day in range(1, 4):
+        archive.add('sw1', 'v{}\n'.format(day).encode('ascii'),
+                    '2026-01-{:02d}T10:00:00'.format(day))
+    assert archive.find_version('sw1', '2025-12-31') is None
+    # A date without time of day includes the whole day
+    assert archive.find_version('sw1', '2026-01-01') == 0
+    assert archive.find_version('sw1', '2026-01-02') == 1
+    assert archive.find_version('sw1', '2026-01-02T09:00:00') == 0
+    assert archive.find_version('sw1', '2026-01-02T10:00:00') == 1
+    assert archive.find_version('sw1', '2026-01-03T12:00:00-01:00') == 2
+    assert archive.find_version('sw1', '2026-01-03T12:00:00+05:00') == 1
+    with pytest.raises(ValueError):
+        archive.find_version('sw1', 'garbage')
+
+
+def test_prune_boundaries(archive, tmp_path):
+    # Chains: versions 0-3, 4-7 and 8-9
+    for day in range(1, 11):
+        archive.add('sw1', 'v{}\n'.format(day).encode('ascii'),
+                    '2026-01-{:02d}T10:00:00'.format(day))
+    # Version 3 (last of the first chain) is not older than the cutoff
+    assert archive.prune('sw1', '2026-01-04T10:00:00') == []
+    assert archive.prune('sw1', '2026-01-04T10:00:01') == [0, 1, 2, 3]
+    assert [x['Version'] for x in archive.list_versions('sw1')] == \
+        list(range(4, 10))
+    for version in range(4, 10):
+        assert archive.get('sw1', version) == \
+            'v{}\n'.format(version + 1).encode('ascii')
+    # The latest chain is always kept
+    assert archive.prune('sw1', '2027-01-01') == [4, 5, 6, 7]
+    assert [x['Version'] for x in archive.list_versions('sw1')] == [8, 9]
+    device_dir = os.path.join(str(tmp_path), os.listdir(str(tmp_path))[0])
+    assert sorted(os.listdir(device_dir)) == \
+        ['8.full', '9.delta', 'index.json']
+
+
+def test_diff(archive):
+    archive.add('sw1', b'a\nb\n', '2026-01-01')
+    archive.add('sw1', b'a\nc', '2026-01-02')
+    diff = list(archive.diff('sw1'))
+    assert diff[2:] == [
+        '@@ -1,2 +1,2 @@\n',
+        ' a\n',
+        '-b\n',
+        '+c\n',
+        '\\ No newline at end of file\n'
+    ]
+    with pytest.raises(ArchiveException):
+        archive.diff('sw2')